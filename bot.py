@@ -1,5 +1,13 @@
 import os
+import asyncio
+import atexit
+import contextvars
+import itertools
 import logging
+import queue
+import time
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
 from aiogram import Bot, Dispatcher, types, F, html
 from datetime import datetime
 import json
@@ -7,16 +15,104 @@ from aiogram.filters import Command, StateFilter, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import TelegramMethod
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types.update import UpdateTypeLookupError
 from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Correlation id of the update currently being handled (set per update by middleware)
+current_update_id = contextvars.ContextVar('current_update_id', default=None)
+
+# Keep 1 of every N records for high-volume events (keyed by `event` extra or logger name).
+# Warnings and errors are never sampled.
+LOG_SAMPLE_EVERY = {
+    'channel.attempt': 10,
+    'channel.sent': 10,
+    'participants.saved': 10,
+    'lane.wait': 20,
+    'aiogram.event': 20,
+}
+
+# Standard LogRecord attributes, so the JSON formatter only emits custom `extra` fields
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Render log records as single-line JSON"""
+    def format(self, record):
+        payload = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and value is not None:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class CorrelationFilter(logging.Filter):
+    """Attach the current update id to every record"""
+    def filter(self, record):
+        if getattr(record, 'update_id', None) is None:
+            record.update_id = current_update_id.get()
+        return True
+
+class SampleFilter(logging.Filter):
+    """Drop all but 1 of every N records for noisy events"""
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self.counters = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, 'event', None) or record.name
+        n = self.every.get(key)
+        if not n:
+            return True
+        counter = self.counters.setdefault(key, itertools.count())
+        return next(counter) % n == 0
+
+class DeferredQueueHandler(QueueHandler):
+    """Enqueue records unformatted so message formatting happens on the listener thread"""
+    def prepare(self, record):
+        return record
+
+def setup_logging():
+    """Route all logging through a queue drained by a background thread"""
+    log_queue = queue.SimpleQueue()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    queue_handler.addFilter(SampleFilter(LOG_SAMPLE_EVERY))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    try:
+        root.setLevel(level)
+    except ValueError:
+        root.setLevel(logging.INFO)
+        logging.getLogger(__name__).warning("Unknown LOG_LEVEL %r, falling back to INFO", level)
 
-# Load environment variables
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# Load environment variables (before logging, which reads LOG_LEVEL)
 load_dotenv()
 
+# Configure logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
 # Bot token from .env file (fallback to hardcoded if .env not available)
 BOT_TOKEN = os.getenv('BOT_TOKEN', "7605069387:AAF4h9zO99LrqWg8JCVYmvYIrpFo1FN8YGc")
 
@@ -28,12 +124,145 @@ CHANNEL_ID = os.getenv('CHANNEL_ID', '5747916482')
 ADMIN_IDS_STR = os.getenv('ADMIN_IDS', '1769729434,5747916482')
 ADMIN_IDS = [int(id.strip()) for id in ADMIN_IDS_STR.split(',') if id.strip()]
 
+def env_positive_int(name, default):
+    """Read a positive integer setting, falling back to the default if invalid"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        logger.warning("Invalid %s=%r (must be a positive integer), using %d", name, value, default)
+        return default
+    return number
+
+# Update scheduling limits
+MAX_CONCURRENT_UPDATES = env_positive_int('MAX_CONCURRENT_UPDATES', 32)
+USER_LANE_SIZE = env_positive_int('USER_LANE_SIZE', 20)
+
 # Global participants list
 participants = []
 
+class UpdateScheduler:
+    """Run updates from different users concurrently, each user's updates in arrival order"""
+    def __init__(self, max_concurrency, lane_size):
+        self.lane_size = lane_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.lanes = {}
+        self.workers = set()
+        self.processed = 0
+        self.dropped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, key, update_id, process):
+        """Queue `process` (a coroutine function) on the lane for `key`"""
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = asyncio.Queue(maxsize=self.lane_size)
+            self.lanes[key] = lane
+            worker = asyncio.create_task(self._run_lane(key, lane))
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+        try:
+            lane.put_nowait((time.monotonic(), update_id, process))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning("Lane for %s is full, dropping update", key,
+                           extra={'event': 'lane.dropped', 'update_id': update_id})
+            return False
+        return True
+
+    async def _run_lane(self, key, lane):
+        """Process one lane's updates sequentially, then retire the lane"""
+        try:
+            while not lane.empty():
+                # Take the slot before dequeuing so the waiting update still counts toward lane_size
+                async with self.semaphore:
+                    queued_at, update_id, process = lane.get_nowait()
+                    wait = time.monotonic() - queued_at
+                    self.processed += 1
+                    self.wait_total += wait
+                    self.wait_max = max(self.wait_max, wait)
+                    logger.info("Update waited %.3fs in lane %s", wait, key,
+                                extra={'event': 'lane.wait', 'update_id': update_id, 'wait': round(wait, 4)})
+                    try:
+                        await process()
+                    except Exception:
+                        logger.exception("Error processing update", extra={'update_id': update_id})
+        finally:
+            # Retire the lane even if the worker was cancelled, so the next submit starts a new one.
+            # No await since the last empty() check, so on normal exit nothing was queued meanwhile.
+            if self.lanes.get(key) is lane:
+                del self.lanes[key]
+            if not lane.empty():
+                self.dropped += lane.qsize()
+                logger.warning("Lane worker for %s stopped, dropping %d queued updates", key, lane.qsize(),
+                               extra={'event': 'lane.dropped'})
+
+    def snapshot(self):
+        """Return current scheduler metrics"""
+        return {
+            'active_lanes': len(self.lanes),
+            'queued': sum(lane.qsize() for lane in self.lanes.values()),
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'wait_avg': self.wait_total / self.processed if self.processed else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+    async def wait_closed(self):
+        """Wait for all queued updates to finish"""
+        while self.workers:
+            await asyncio.gather(*self.workers, return_exceptions=True)
+
+def update_lane_key(update):
+    """Return the lane key for an update: the sender's user ID, or a unique key"""
+    try:
+        user = getattr(update.event, 'from_user', None)
+    except UpdateTypeLookupError:
+        user = None
+    if user is not None:
+        return user.id
+    return ('update', update.update_id)
+
+class CorrelatedDispatcher(Dispatcher):
+    """Dispatcher that tags log records emitted while handling an update with its id"""
+    async def feed_update(self, bot, update, **kwargs):
+        # Wrap the whole call so aiogram's own "Update id=... is handled" line is tagged too
+        token = current_update_id.set(update.update_id)
+        try:
+            return await super().feed_update(bot, update, **kwargs)
+        finally:
+            current_update_id.reset(token)
+
+class OrderedDispatcher(CorrelatedDispatcher):
+    """Dispatcher that hands updates to an UpdateScheduler instead of handling them inline
+
+    Polling only: feed_update returns None once the update is queued, so webhook
+    callers (feed_webhook_update / feed_raw_update) never see a handler response.
+    A TelegramMethod returned by a handler is still executed, from inside the lane.
+    """
+    def __init__(self, scheduler, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+
+    async def feed_update(self, bot, update, **kwargs):
+        process = partial(self._process_in_lane, bot, update, **kwargs)
+        self.scheduler.submit(update_lane_key(update), update.update_id, process)
+
+    async def _process_in_lane(self, bot, update, **kwargs):
+        """Handle the update and run any method the handler returned"""
+        response = await super().feed_update(bot, update, **kwargs)
+        if isinstance(response, TelegramMethod):
+            await self.silent_call_request(bot=bot, result=response)
+
 # Initialize bot and dispatcher
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+scheduler = UpdateScheduler(MAX_CONCURRENT_UPDATES, USER_LANE_SIZE)
+dp = OrderedDispatcher(scheduler, storage=MemoryStorage())
 
 def is_admin(user_id):
     """Check if user is admin"""
@@ -88,16 +317,16 @@ async def notify_channel(participant_data):
                     message.append(member_info)
         
         # Try sending to channel username first
-        logger.info(f"Attempting to send to channel: {CHANNEL_USERNAME}")
+        logger.info("Attempting to send to channel %s", CHANNEL_USERNAME, extra={'event': 'channel.attempt'})
         try:
             await bot.send_message(
                 chat_id=CHANNEL_USERNAME,
                 text="\n".join(message),
                 parse_mode='HTML'
             )
-            logger.info("Successfully sent to channel via username")
+            logger.info("Successfully sent to channel via username", extra={'event': 'channel.sent'})
         except Exception as username_error:
-            logger.error(f"Failed to send via username {CHANNEL_USERNAME}: {username_error}")
+            logger.error("Failed to send via username %s: %s", CHANNEL_USERNAME, username_error)
             
             # Try with CHANNEL_ID if available
             if CHANNEL_ID:
@@ -107,16 +336,15 @@ async def notify_channel(participant_data):
                         text="\n".join(message),
                         parse_mode='HTML'
                     )
-                    logger.info("Successfully sent to channel via ID")
+                    logger.info("Successfully sent to channel via ID", extra={'event': 'channel.sent'})
                 except Exception as id_error:
-                    logger.error(f"Failed to send via ID {CHANNEL_ID}: {id_error}")
+                    logger.error("Failed to send via ID %s: %s", CHANNEL_ID, id_error)
                     raise id_error
             else:
                 raise username_error
                 
     except Exception as e:
-        logger.error(f"Error sending to channel: {e}")
-        print(f"Error sending to channel: {e}")
+        logger.error("Error sending to channel: %s", e)
         # Send error notification to admins
         for admin_id in ADMIN_IDS:
             try:
@@ -169,10 +397,10 @@ async def notify_admin(participant_data):
                     parse_mode='HTML'
                 )
             except Exception as e:
-                logger.error(f"Error sending to admin {admin_id}: {e}")
+                logger.error("Error sending to admin %s: %s", admin_id, e)
                 
     except Exception as e:
-        logger.error(f"Error in notify_admin: {e}")
+        logger.error("Error in notify_admin: %s", e)
 
 # States
 class Form(StatesGroup):
@@ -326,7 +554,7 @@ async def process_team_members(message: types.Message, state: FSMContext):
         await complete_registration(message, state)
         
     except Exception as e:
-        logger.error(f"Error processing team members: {e}")
+        logger.error("Error processing team members: %s", e)
         await message.answer(
             "❌ Invalid format. Please try again. Format should be:\n"
             "Full Name, Phone Number\n"
@@ -575,14 +803,34 @@ async def test_channel(message: types.Message):
     await notify_channel(test_data)
     await message.answer("✅ Test notification sent! Check the channel and logs.")
 
+# Scheduler metrics command
+@dp.message(Command("lanes"))
+async def show_lanes(message: types.Message):
+    """Show update scheduler metrics (admin only)"""
+    if not is_admin(message.from_user.id):
+        await message.answer("🚫 Access denied.")
+        return
+
+    stats = scheduler.snapshot()
+    response = [
+        "⏱ Update Scheduler",
+        f"🛣 Active lanes: {stats['active_lanes']}",
+        f"📥 Queued updates: {stats['queued']}",
+        f"✅ Processed: {stats['processed']}",
+        f"🗑 Dropped: {stats['dropped']}",
+        f"⌛ Lane wait avg: {stats['wait_avg'] * 1000:.1f} ms",
+        f"⌛ Lane wait max: {stats['wait_max'] * 1000:.1f} ms",
+    ]
+    await message.answer("\n".join(response))
+
 def save_participants():
     """Save participants to a JSON file"""
     try:
         with open('participants.json', 'w', encoding='utf-8') as f:
             json.dump(participants, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved {len(participants)} participants to file")
+        logger.info("Saved %d participants to file", len(participants), extra={'event': 'participants.saved'})
     except Exception as e:
-        logger.error(f"Error saving participants: {e}")
+        logger.error("Error saving participants: %s", e)
 
 def load_participants():
     """Load participants from JSON file"""
@@ -590,12 +838,12 @@ def load_participants():
     try:
         with open('participants.json', 'r', encoding='utf-8') as f:
             participants = json.load(f)
-        logger.info(f"Loaded {len(participants)} participants from file")
+        logger.info("Loaded %d participants from file", len(participants))
     except FileNotFoundError:
         participants = []
         logger.info("No existing participants file found, starting fresh")
     except Exception as e:
-        logger.error(f"Error loading participants: {e}")
+        logger.error("Error loading participants: %s", e)
         participants = []
 
 # Message forwarding handler
@@ -636,13 +884,13 @@ async def handle_other_messages(message: types.Message):
                             parse_mode='Markdown'
                         )
                     except Exception as e:
-                        logger.error(f"Error forwarding to admin {admin_id}: {e}")
+                        logger.error("Error forwarding to admin %s: %s", admin_id, e)
                 
                 # Confirm to user
                 await message.answer("✅ Your message has been forwarded to the group!")
                 
             except Exception as e:
-                logger.error(f"Error forwarding message: {e}")
+                logger.error("Error forwarding message: %s", e)
                 await message.answer("❌ Error forwarding your message. Please try again.")
     else:
         # Handle unregistered users
@@ -664,19 +912,20 @@ async def main():
     logger.info("Starting registration bot...")
     load_participants()
     try:
-        await dp.start_polling(bot, skip_pending=True)
+        # Polling only enqueues updates; the scheduler runs them, so keep intake sequential
+        await dp.start_polling(bot, skip_pending=True, handle_as_tasks=False)
     except Exception as e:
-        logger.error(f"Error during polling: {e}")
+        logger.error("Error during polling: %s", e)
         raise
     finally:
+        await scheduler.wait_closed()
         await bot.session.close()
 
 if __name__ == '__main__':
     try:
-        import asyncio
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Bot stopped by user")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
+        logger.error("Fatal error: %s", e)
         raise